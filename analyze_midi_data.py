@@ -1,306 +1,452 @@
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from itertools import accumulate
 import argparse
+import hashlib
+import mmap
+import os
+import pickle
+import struct
 import sys
-import mido
+
+# Event type codes used in note event tuples
+NOTE_OFF = 0
+NOTE_ON = 1
+
+# Note names for every MIDI note number (0-127), e.g. 60 -> 'C4'
+NOTE_NAMES = tuple(
+    f"{['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B'][note % 12]}{note // 12 - 1}"
+    for note in range(128)
+)
+
+# Labels for each 16th-note position in a measure, e.g. 6 -> '2.2'. Positions
+# run past 15 when ppqn is not a multiple of 4 (up to 27 for a ppqn of 7), so
+# the table covers 28 positions.
+READABLE_POS = tuple(f"{pos // 4 + 1}{['', '.1', '.2', '.3'][pos % 4]}" for pos in range(28))
+
+# Version tag mixed into the note event cache keys; bump it whenever the
+# layout of the cached (event_types, notes, deltas, ppqn) tuple changes
+CACHE_FORMAT = 'note-events-1'
+
+# Precompiled unpackers for the chunk header (type, length) shared by MThd
+# and MTrk chunks, and for the MThd fields (format, track count, PPQN)
+CHUNK_HEADER = struct.Struct('>4sL')
+FILE_HEADER_FIELDS = struct.Struct('>hhh')
+
+# Number of data bytes following each status byte (None if undefined).
+# Meta (0xFF) and sysex (0xF0/0xF7) events carry their own length instead.
+MESSAGE_DATA_LENGTHS = tuple(
+    1 if 0xC0 <= status < 0xE0 else
+    2 if 0x80 <= status < 0xF0 else
+    {0xF1: 1, 0xF2: 2, 0xF3: 1, 0xF6: 0, 0xF8: 0, 0xFA: 0, 0xFB: 0, 0xFC: 0, 0xFE: 0}.get(status)
+    for status in range(256)
+)
+
+def read_variable_int(data, pos):
+    """
+    Decode a variable-length quantity from raw MIDI file bytes
+    
+    Args:
+        data (bytes): Raw MIDI file contents
+        pos (int): Offset of the first byte of the quantity
+        
+    Returns:
+        tuple: (value, pos), where pos is the offset just past the quantity
+    """
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+def parse_note_events(data):
+    """
+    Decode the note events of a Standard MIDI File from its raw bytes
+    
+    Every track chunk is walked once and only note_on/note_off messages are
+    kept, while all other events are skipped over by their length.
+    
+    Args:
+        data (bytes): Raw MIDI file contents (any buffer indexable by byte)
+        
+    Returns:
+        tuple: (event_types, notes, deltas, ppqn), where the first three are
+            parallel arrays holding each note event's type (NOTE_ON or
+            NOTE_OFF), note number and delta time
+    """
+    # Header chunk: b'MThd', length, then format, track count and PPQN
+    if len(data) < 8:
+        raise EOFError('file too short for a MIDI header')
+    chunk_type, header_length = CHUNK_HEADER.unpack_from(data, 0)
+    if chunk_type != b'MThd':
+        raise OSError('MThd not found. Probably not a MIDI file')
+    if header_length < 6 or len(data) < 14:
+        raise EOFError('truncated MIDI header')
+    _, num_tracks, ppqn = FILE_HEADER_FIELDS.unpack_from(data, 8)
+    pos = 8 + header_length
+    
+    # One compact array per event field instead of a tuple per event
+    event_types = array('B')
+    notes = array('B')
+    deltas = array('L')
+    add_type = event_types.append
+    add_note = notes.append
+    add_delta = deltas.append
+    
+    # Process each track
+    for _ in range(num_tracks):
+        if len(data) < pos + 8:
+            raise EOFError('missing track chunk')
+        chunk_type, chunk_length = CHUNK_HEADER.unpack_from(data, pos)
+        if chunk_type != b'MTrk':
+            raise OSError('no MTrk header at start of track')
+        pos += 8
+        end = pos + chunk_length
+        if end > len(data):
+            raise EOFError('truncated track chunk')
+        
+        status = None
+        while pos < end:
+            # Delta time, decoded inline since every event has one
+            delta = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                delta = (delta << 7) | (byte & 0x7F)
+                if byte < 0x80:
+                    break
+            
+            # A data byte here means running status: reuse the last status
+            byte = data[pos]
+            if byte >= 0x80:
+                pos += 1
+                if byte == 0xFF:
+                    # Meta event: type byte, then length-prefixed payload.
+                    # Meta events don't change the running status. Their
+                    # payloads aren't decoded, so unlike mido a malformed
+                    # tempo or key signature doesn't reject the file.
+                    length, pos = read_variable_int(data, pos + 1)
+                    pos += length
+                    continue
+                status = byte
+            elif status is None:
+                raise OSError('running status without last_status')
+            
+            kind = status & 0xF0
+            if kind == 0x90 or kind == 0x80:
+                note = data[pos]
+                velocity = data[pos + 1]
+                pos += 2
+                if (note | velocity) > 0x7F:
+                    raise OSError('data byte must be in range 0..127')
+                
+                # Convert velocity=0 note_on messages to note_off
+                add_type(NOTE_ON if kind == 0x90 and velocity else NOTE_OFF)
+                add_note(note)
+                add_delta(delta)
+            elif status == 0xF0 or status == 0xF7:
+                # Sysex event: length-prefixed payload. Under running status
+                # the data byte in front of the length is dropped, as in mido.
+                if byte < 0x80:
+                    pos += 1
+                length, pos = read_variable_int(data, pos)
+                
+                # Apart from the framing F0/F7 bytes the payload must be 7-bit
+                payload = data[pos:pos + length]
+                if payload[:1] == b'\xf0':
+                    payload = payload[1:]
+                if payload[-1:] == b'\xf7':
+                    payload = payload[:-1]
+                if max(payload, default=0) > 0x7F:
+                    raise OSError('data byte must be in range 0..127')
+                pos += length
+            else:
+                length = MESSAGE_DATA_LENGTHS[status]
+                if length is None:
+                    raise OSError(f'undefined status byte 0x{status:02x}')
+                
+                # Messages without data bytes can't be repeated by running
+                # status, and the skipped data bytes must still be valid
+                if byte < 0x80 and not length:
+                    raise OSError(f'wrong number of bytes for status byte 0x{status:02x}')
+                if max(data[pos:pos + length], default=0) > 0x7F:
+                    raise OSError('data byte must be in range 0..127')
+                pos += length
+        
+        if pos != end:
+            raise OSError('event runs past the end of its track chunk')
+    
+    return event_types, notes, deltas, ppqn
 
 def extract_note_events(midi_file):
     """
     Extract note events and PPQN from a MIDI file
     
+    The file is memory-mapped rather than read, so large files are parsed
+    in place without first being copied into memory.
+    
     Args:
         midi_file (str): Path to MIDI file
         
     Returns:
-        tuple: (note_events, ppqn)
+        tuple: (event_types, notes, deltas, ppqn), as from parse_note_events
     """
     try:
-        midi = mido.MidiFile(midi_file)
-        ppqn = midi.ticks_per_beat
-        
-        note_events = []
-        
-        # Process each track
-        for track in midi.tracks:
-            # Process messages in this track
-            for msg in track:
-                if msg.type in ('note_on', 'note_off'):
-                    # Convert velocity=0 note_on messages to note_off
-                    if msg.type == 'note_on' and msg.velocity == 0:
-                        msg_type = 'note_off'
-                    else:
-                        msg_type = msg.type
-                    
-                    note_events.append({
-                        'type': msg_type,
-                        'note': msg.note,
-                        'time': msg.time
-                    })
-        
-        return note_events, ppqn
+        with open(midi_file, 'rb') as f:
+            # Empty files can't be mapped
+            if not os.fstat(f.fileno()).st_size:
+                return parse_note_events(b'')
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_note_events(data)
     
     except Exception as e:
         print(f"Error processing {midi_file}: {str(e)}")
-        return None, None
+        return None, None, None, None
 
-def analyze_rhythm_pattern(note_events, ppqn):
+def load_note_events(midi_file, cache_dir=None):
     """
-    Analyze both the rhythm and melodic patterns from the note events
+    Extract note events from a MIDI file, reusing an on-disk cache if given
+    
+    Cache entries are keyed by the cache format, the file's absolute path,
+    modification time and size, so editing or replacing a file invalidates
+    its entry. Files that fail to parse are not cached, and a cache directory
+    that can't be written to only disables caching.
     
     Args:
-        note_events (list): List of note events
-        ppqn (int): Pulses Per Quarter Note
+        midi_file (str): Path to MIDI file
+        cache_dir (str): Directory for cached results, or None to always parse
         
     Returns:
-        set: Set of unique rhythm patterns in the file (as frozensets)
+        tuple: (event_types, notes, deltas, ppqn), as from extract_note_events
     """
-    if not note_events:
-        print("No note events to analyze")
-        return set()
+    if cache_dir is None:
+        return extract_note_events(midi_file)
     
-    # Convert note timings to absolute positions
-    absolute_times = []
-    current_time = 0
+    try:
+        stat = os.stat(midi_file)
+    except OSError:
+        # Let the parser report the problem
+        return extract_note_events(midi_file)
     
-    # Group notes by their absolute start times
-    notes_by_time = defaultdict(list)
+    key = f"{CACHE_FORMAT}|{os.path.abspath(midi_file)}|{stat.st_mtime_ns}|{stat.st_size}"
+    cache_file = os.path.join(cache_dir, hashlib.blake2b(key.encode()).hexdigest() + '.pickle')
     
-    # Track when notes start and end for visualization
-    note_timeline = {}
+    # Any entry that can't be read or doesn't hold the expected tuple is
+    # treated as a miss and overwritten below
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        cached = None
+    
+    if (isinstance(cached, tuple) and len(cached) == 4
+            and all(isinstance(field, array) for field in cached[:3])
+            and isinstance(cached[3], int)):
+        return cached
+    
+    result = extract_note_events(midi_file)
+    
+    if result[0] is not None:
+        # Write to a temporary file first so concurrent runs never see a
+        # partially written entry. Caching is best-effort: if the entry
+        # can't be written the parsed result is still returned.
+        temp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(temp_file, 'wb') as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file, cache_file)
+        except OSError:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+    
+    return result
+
+def extract_measure_patterns(event_types, notes, deltas, ppqn):
+    """
+    Walk the note events once and bucket every onset into its measure
     
-    for event in note_events:
-        current_time += event['time']
+    Args:
+        event_types (array): Type of each note event (NOTE_ON or NOTE_OFF)
+        notes (array): Note number of each note event
+        deltas (array): Delta time of each note event
+        ppqn (int): Pulses Per Quarter Note
         
-        if event['type'] == 'note_on':
-            absolute_times.append(current_time)
-            notes_by_time[current_time].append(event['note'])
-            
-            # Start tracking this note in the timeline
-            if event['note'] not in note_timeline:
-                note_timeline[event['note']] = []
-            note_timeline[event['note']].append({'start': current_time, 'end': None})
-        elif event['type'] == 'note_off':
-            # Find the most recent note_on for this note and mark its end
-            if event['note'] in note_timeline and note_timeline[event['note']]:
-                # Find the most recent unended note
-                for note_event in reversed(note_timeline[event['note']]):
-                    if note_event['end'] is None:
-                        note_event['end'] = current_time
-                        break
-    
-    # Create a rhythm visualization
-    print("\n--- RHYTHM PHRASAL STRUCTURE ANALYSIS ---")
+    Returns:
+        tuple: (measure_masks, measure_note_sequences, max_time), where each
+            measure's mask has bit p set iff a note starts at 16th-note
+            position p, and each note sequence is a sorted list of
+            (position, note) pairs
+    """
+    # Every onset as a (time, note) pair, converting note timings to absolute
+    # positions as we go. Note-off events only advance the clock.
+    onsets = [
+        (current_time, note)
+        for event_type, note, current_time in zip(event_types, notes, accumulate(deltas))
+        if event_type == NOTE_ON
+    ]
     
     # Detect measure length (assuming 4/4 time signature)
     measure_length = 4 * ppqn  # 4 quarter notes per measure
     
-    # Create a rhythm grid
-    max_time = max(absolute_times) if absolute_times else 0
+    # A single sort orders the onsets by time and, within a time, by pitch,
+    # so notes struck together and whole measures are contiguous runs
+    onsets.sort()
+    onset_times = [time for time, _ in onsets]
+    onset_notes = [note for _, note in onsets]
+    
+    max_time = onset_times[-1] if onset_times else 0
     measures = (max_time // measure_length) + 1
     
-    print(f"Total measures: {int(measures)}")
-    print(f"Total duration: {max_time} ticks ({max_time / ppqn:.2f} quarter notes)")
+    # Convert every onset to its 16th-note position (0-15) within its measure
+    # in a single pass, kept parallel to onset_times
+    sixteenth = ppqn // 4
+    positions = [(time % measure_length) // sixteenth for time in onset_times]
     
-    # Collect all onset positions for each measure
-    measure_onset_patterns = []
-    for measure in range(int(measures)):
-        measure_start = measure * measure_length
-        measure_end = (measure + 1) * measure_length
-        
-        # Get all onset times in this measure, normalized to 16th notes (0-15)
-        onsets = []
-        for time in sorted(notes_by_time.keys()):
-            if measure_start <= time < measure_end:
-                # Convert to 16th-note position (0-15) within the measure
-                pos_in_measure = (time - measure_start) // (ppqn // 4)
-                onsets.append(int(pos_in_measure))
-        
-        measure_onset_patterns.append(sorted(onsets))
+    # Build the rhythmic onset masks and the melodic note sequences for each
+    # measure in the same pass. The times are sorted, so each measure is a
+    # slice already in order.
+    measure_masks = []
+    measure_note_sequences = []
+    for measure in range(measures):
+        lo = bisect_left(onset_times, measure * measure_length)
+        hi = bisect_left(onset_times, (measure + 1) * measure_length)
+        measure_positions = positions[lo:hi]
         
-    # Identify identical measures rhythmically
-    identical_measures = defaultdict(list)
-    for i, pattern1 in enumerate(measure_onset_patterns):
-        for j, pattern2 in enumerate(measure_onset_patterns):
-            if i != j and pattern1 == pattern2:
-                identical_measures[i].append(j)
-    
-    # Find measure groups
-    measure_groups = []
-    processed = set()
-    
-    for i in range(len(measure_onset_patterns)):
-        if i in processed:
-            continue
-            
-        group = [i]
-        processed.add(i)
+        # Rhythm: mark every occupied 16th-note slot
+        measure_masks.append(onsets_to_mask(measure_positions))
         
-        for j in identical_measures.get(i, []):
-            if j not in processed:
-                group.append(j)
-                processed.add(j)
+        # Melody: pair each note with its onset position and sort by position
+        # within the measure. Onsets closer together than a 16th note share a
+        # position, so their pitches still need to be ordered together.
+        measure_note_sequences.append(sorted(zip(measure_positions, onset_notes[lo:hi])))
+    
+    return measure_masks, measure_note_sequences, max_time
+
+def analyze_rhythm_pattern(event_types, notes, deltas, ppqn, measure_patterns=None):
+    """
+    Analyze both the rhythm and melodic patterns from the note events
+    
+    Args:
+        event_types (array): Type of each note event (NOTE_ON or NOTE_OFF)
+        notes (array): Note number of each note event
+        deltas (array): Delta time of each note event
+        ppqn (int): Pulses Per Quarter Note
+        measure_patterns (tuple, optional): Result of extract_measure_patterns
+            for these events, computed here if not given
         
-        if group:
-            measure_groups.append(sorted(group))
+    Returns:
+        set: Set of unique rhythm patterns in the file (as onset bitmasks)
+    """
+    if not deltas:
+        print("No note events to analyze")
+        return set()
     
+    # Files with only note_off events (or velocity=0 note_ons) have no onsets,
+    # so there are no measures to analyze
+    if NOTE_ON not in event_types:
+        print("No note onsets to analyze")
+        return set()
     
-    # Analyze pattern sequence
-    pattern_sequence = []
-    pattern_map = {}
+    if measure_patterns is None:
+        measure_patterns = extract_measure_patterns(event_types, notes, deltas, ppqn)
+    measure_masks, measure_note_sequences, max_time = measure_patterns
+    measures = len(measure_masks)
     
-    for i in range(len(measure_groups)):
-        pattern_map[i] = chr(65 + i)  # A, B, C, etc.
+    # Collect the report lines and write them out in one go at the end
+    out = []
     
-    for i in range(len(measure_onset_patterns)):
-        for group_idx, group in enumerate(measure_groups):
-            if i in group:
-                pattern_sequence.append(pattern_map[group_idx])
-                break
-        
-    # Find repeating patterns in the sequence
-    if len(pattern_sequence) > 1:
-        
-        # Check for different repeating pattern lengths
-        for pattern_length in range(1, len(pattern_sequence) // 2 + 1):
-            for start in range(len(pattern_sequence) - pattern_length):
-                subpattern = pattern_sequence[start:start+pattern_length]
-
-    # Now analyze melodic patterns
+    # Create a rhythm visualization
+    out.append("\n--- RHYTHM PHRASAL STRUCTURE ANALYSIS ---")
     
-    # Create a list of note sequences by measure, preserving onset order and notes
-    measure_note_sequences = []
+    out.append(f"Total measures: {measures}")
+    out.append(f"Total duration: {max_time} ticks ({max_time / ppqn:.2f} quarter notes)")
     
-    for measure in range(int(measures)):
-        measure_start = measure * measure_length
-        measure_end = (measure + 1) * measure_length
-        
-        # Get all notes with their onset times in this measure
-        measure_notes = []
-        for time in sorted(notes_by_time.keys()):
-            if measure_start <= time < measure_end:
-                # Convert to relative position in the measure (16th notes)
-                pos_in_measure = (time - measure_start) // (ppqn // 4)
-                # Include both position and notes
-                for note in sorted(notes_by_time[time]):
-                    measure_notes.append((int(pos_in_measure), note))
-        
-        # Sort by onset time within measure
-        measure_note_sequences.append(sorted(measure_notes))
-    
-    # Print note sequences for each measure
-    for i, sequence in enumerate(measure_note_sequences):
-        for pos, note in sequence:
-            beat = (pos // 4) + 1  # Convert to 1-indexed beat number
-            subdivision = pos % 4  # Subdivision within beat
-            
-            # Format subdivision as text
-            if subdivision == 0:
-                beat_pos = f"Beat {beat}"
-            elif subdivision == 1:
-                beat_pos = f"Beat {beat}+"
-            elif subdivision == 2:
-                beat_pos = f"Beat {beat}&"
-            else:
-                beat_pos = f"Beat {beat}a"
-                
-            note_name = get_note_name(note)
-    
-    # Compare melodic sequences between measures
-    identical_melodic_measures = defaultdict(list)
-    for i, seq1 in enumerate(measure_note_sequences):
-        for j, seq2 in enumerate(measure_note_sequences):
-            if i != j:
-                # Compare full note sequences including both timing and pitch
-                if seq1 == seq2:
-                    identical_melodic_measures[i].append(j)
-    
-    # Find melodic measure groups
-    melodic_measure_groups = []
-    processed = set()
-    
-    for i in range(len(measure_note_sequences)):
-        if i in processed:
-            continue
-            
-        group = [i]
-        processed.add(i)
-        
-        for j in identical_melodic_measures.get(i, []):
-            if j not in processed:
-                group.append(j)
-                processed.add(j)
-        
-        if group:
-            melodic_measure_groups.append(sorted(group))
+    # Group rhythmically identical measures by their onset bitmask
+    identical_measures = defaultdict(list)
+    for i, mask in enumerate(measure_masks):
+        identical_measures[mask].append(i)
     
+    # Find measure groups, ordered by their first occurrence
+    measure_groups = sorted(identical_measures.values(), key=lambda group: group[0])
     
-    # Analyze melodic pattern sequence
-    melodic_pattern_sequence = []
-    melodic_pattern_map = {}
     
-    for i in range(len(melodic_measure_groups)):
-        melodic_pattern_map[i] = chr(65 + i)  # A, B, C, etc.
+    # Analyze pattern sequence: label each measure with its group's letter
+    pattern_sequence = [None] * measures
     
-    for i in range(len(measure_note_sequences)):
-        for group_idx, group in enumerate(melodic_measure_groups):
-            if i in group:
-                melodic_pattern_sequence.append(melodic_pattern_map[group_idx])
-                break
+    for group_idx, group in enumerate(measure_groups):
+        for i in group:
+            pattern_sequence[i] = chr(65 + group_idx)  # A, B, C, etc.
+    
+    # Now analyze melodic patterns
+    
+    # Measures with the same note sequence always share an onset mask, so the
+    # melodic grouping can only split the rhythmic groups further. If every
+    # measure is already rhythmically distinct, it is melodically distinct too.
+    if len(measure_groups) == measures:
+        melodic_pattern_sequence = list(pattern_sequence)
+    else:
+        # Group melodically identical measures by hashing the full note
+        # sequence (both timing and pitch)
+        identical_melodic_measures = defaultdict(list)
+        for i, sequence in enumerate(measure_note_sequences):
+            identical_melodic_measures[tuple(sequence)].append(i)
         
+        # Find melodic measure groups, ordered by their first occurrence
+        melodic_measure_groups = sorted(identical_melodic_measures.values(), key=lambda group: group[0])
+        
+        # Analyze melodic pattern sequence: label each measure with its group's letter
+        melodic_pattern_sequence = [None] * len(measure_note_sequences)
+        
+        for group_idx, group in enumerate(melodic_measure_groups):
+            for i in group:
+                melodic_pattern_sequence[i] = chr(65 + group_idx)  # A, B, C, etc.
     
     # Compare rhythmic and melodic patterns
-    print("\n--- COMBINED RHYTHM AND MELODIC ANALYSIS ---")
+    out.append("\n--- COMBINED RHYTHM AND MELODIC ANALYSIS ---")
     if pattern_sequence == melodic_pattern_sequence:
-        print("The rhythmic and melodic patterns match exactly.")
+        out.append("The rhythmic and melodic patterns match exactly.")
     else:
-        print("The rhythmic and melodic patterns differ:")
-        print(f"  Rhythmic: {''.join(pattern_sequence)}")
-        print(f"  Melodic:  {''.join(melodic_pattern_sequence)}")
+        out.append("The rhythmic and melodic patterns differ:")
+        out.append(f"  Rhythmic: {''.join(pattern_sequence)}")
+        out.append(f"  Melodic:  {''.join(melodic_pattern_sequence)}")
     
     
     # Get all unique notes for range information
     all_notes = set()
-    for events in notes_by_time.values():
-        all_notes.update(events)
+    for sequence in measure_note_sequences:
+        all_notes.update(note for _, note in sequence)
     
     note_range = (min(all_notes), max(all_notes))
-    print(f"\nNote range: {get_note_name(note_range[0])} to {get_note_name(note_range[1])}")
+    out.append(f"\nNote range: {get_note_name(note_range[0])} to {get_note_name(note_range[1])}")
     
     # Calculate the rhythmic density
-    density = len(absolute_times) / int(measures)
-    print(f"Rhythmic density: {density:.2f} onsets per measure")
+    onset_count = sum(len(sequence) for sequence in measure_note_sequences)
+    density = onset_count / measures
+    out.append(f"Rhythmic density: {density:.2f} onsets per measure")
     
     # Analyze unique 1-bar rhythm patterns
-    unique_patterns = set()
-    for pattern in measure_onset_patterns:
-        unique_patterns.add(frozenset(pattern))
-    
-    print(f"\nNumber of unique 1-bar rhythm patterns: {len(unique_patterns)}")
-    print("\nUnique 1-bar rhythm patterns:")
-    print("-" * 40)
-    
-    # Convert frozensets to sorted lists for better display
-    sorted_patterns = [sorted(list(pattern)) for pattern in unique_patterns]
-    sorted_patterns.sort(key=lambda x: (len(x), x if x else [-1]))  # Sort by length, then by content
-    
-    for i, pattern in enumerate(sorted_patterns, 1):
-        # Convert 16th note positions to more readable format
-        readable_positions = []
-        for pos in pattern:
-            beat = (pos // 4) + 1
-            subdivision = pos % 4
-            
-            if subdivision == 0:
-                beat_pos = f"{beat}"
-            elif subdivision == 1:
-                beat_pos = f"{beat}.1"
-            elif subdivision == 2:
-                beat_pos = f"{beat}.2"
-            else:
-                beat_pos = f"{beat}.3"
-                
-            readable_positions.append(beat_pos)
+    unique_patterns = set(measure_masks)
+    
+    out.append(f"\nNumber of unique 1-bar rhythm patterns: {len(unique_patterns)}")
+    out.append("\nUnique 1-bar rhythm patterns:")
+    out.append("-" * 40)
+    
+    # Sort by number of onsets, then by bitmask value
+    sorted_masks = sorted(unique_patterns, key=lambda mask: (bin(mask).count('1'), mask))
+    
+    for i, mask in enumerate(sorted_masks, 1):
+        # Decode the bitmask and convert the 16th note positions to a more
+        # readable format
+        readable_positions = [READABLE_POS[pos] for pos in mask_to_onsets(mask)]
         
-        print(f"Pattern {i}: {' '.join(readable_positions)}")
+        out.append(f"Pattern {i}: {' '.join(readable_positions)}")
     
     # Identify section boundaries based on melodic pattern changes
     if len(melodic_pattern_sequence) > 1:
@@ -330,16 +476,34 @@ def analyze_rhythm_pattern(note_events, ppqn):
         
         # Describe the overall form
         form = ''.join([section['pattern'] for section in sections])
-        print(f"\nOverall melodic form: {form}")
-        
+        out.append(f"\nOverall melodic form: {form}")
+    
+    sys.stdout.write('\n'.join(out) + '\n')
+    
     return unique_patterns
 
+def onsets_to_mask(onsets):
+    """
+    Pack 16th-note onset positions into an int bitmask
+    
+    Args:
+        onsets (list): 16th-note positions within a measure
+        
+    Returns:
+        int: Bitmask with bit p set iff there is an onset at position p
+    """
+    mask = 0
+    for pos in onsets:
+        mask |= 1 << pos
+    return mask
+
+def mask_to_onsets(mask):
+    """Unpack an onset bitmask into a sorted list of 16th-note positions"""
+    return [pos for pos in range(mask.bit_length()) if mask >> pos & 1]
+
 def get_note_name(midi_note):
     """Convert MIDI note number to note name"""
-    notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-    octave = (midi_note // 12) - 1
-    note = notes[midi_note % 12]
-    return f"{note}{octave}"
+    return NOTE_NAMES[midi_note]
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze a MIDI file for rhythm patterns')
@@ -347,10 +511,10 @@ def main():
     
     args = parser.parse_args()
     
-    note_events, ppqn = extract_note_events(args.midi_file)
+    event_types, notes, deltas, ppqn = extract_note_events(args.midi_file)
     
-    if note_events and ppqn:
-        analyze_rhythm_pattern(note_events, ppqn)
+    if deltas and ppqn:
+        analyze_rhythm_pattern(event_types, notes, deltas, ppqn)
     else:
         print(f"Could not analyze {args.midi_file}")
         sys.exit(1)
@@ -1,279 +1,212 @@
 #!/usr/bin/env python3
 import os
 import argparse
+import io
 import sys
 import json
-from analyze_midi_data import analyze_rhythm_pattern, extract_note_events
-from collections import Counter, defaultdict
+import heapq
+import multiprocessing
+from analyze_midi_data import NOTE_ON, READABLE_POS, analyze_rhythm_pattern, extract_measure_patterns, load_note_events, mask_to_onsets
+from collections import Counter
+from contextlib import redirect_stdout
+from functools import partial
+
+# File extensions recognized as MIDI files (compared lowercased)
+MIDI_EXTENSIONS = frozenset({'.mid', '.midi'})
 
 def find_midi_files(directory):
     """
     Recursively find all MIDI files (.mid, .midi) in the given directory
     
+    Directories are scanned lazily in the same top-down order as os.walk,
+    so paths are yielded as soon as their directory has been read.
+    
     Args:
         directory (str): Path to search
         
-    Returns:
-        list: List of paths to MIDI files
+    Yields:
+        str: Path to each MIDI file
     """
-    midi_files = []
+    stack = [directory]
     
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(('.mid', '.midi')):
-                midi_files.append(os.path.join(root, file))
-    
-    return midi_files
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            # Skip unreadable directories, as os.walk does
+            continue
+        
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                
+                if is_dir:
+                    # Don't descend into symlinked directories
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                else:
+                    # Lowercase only the extension, not the whole name. With no
+                    # '.', rfind gives -1 and the slice is just the last character.
+                    name = entry.name
+                    if name[name.rfind('.'):].lower() in MIDI_EXTENSIONS:
+                        yield entry.path
+        
+        # Push in reverse so subdirectories are visited in listing order
+        stack.extend(reversed(subdirectories))
 
-def extract_pattern_sequences(note_events, ppqn):
+def extract_pattern_sequences(event_types, notes, deltas, ppqn, measure_patterns=None):
     """
     Extract both rhythmic and melodic pattern sequences from note events
     
     Args:
-        note_events (list): List of note events
+        event_types (array): Type of each note event (NOTE_ON or NOTE_OFF)
+        notes (array): Note number of each note event
+        deltas (array): Delta time of each note event
         ppqn (int): Pulses Per Quarter Note
+        measure_patterns (tuple, optional): Result of extract_measure_patterns
+            for these events, computed here if not given
         
     Returns:
-        tuple: (rhythmic_pattern, melodic_pattern)
+        tuple: (rhythmic_pattern, melodic_pattern, measure_masks), where each
+            measure's mask has bit p set iff a note starts at 16th-note
+            position p
     """
-    from collections import defaultdict
-    
-    if not note_events:
+    if not deltas or NOTE_ON not in event_types:
         return "", "", []
     
-    # Convert note timings to absolute positions
-    absolute_times = []
-    current_time = 0
-    
-    # Group notes by their absolute start times
-    notes_by_time = defaultdict(list)
-    
-    # Track when notes start and end for visualization
-    note_timeline = {}
-    
-    for event in note_events:
-        current_time += event['time']
-        
-        if event['type'] == 'note_on':
-            absolute_times.append(current_time)
-            notes_by_time[current_time].append(event['note'])
-            
-            # Start tracking this note in the timeline
-            if event['note'] not in note_timeline:
-                note_timeline[event['note']] = []
-            note_timeline[event['note']].append({'start': current_time, 'end': None})
-        elif event['type'] == 'note_off':
-            # Find the most recent note_on for this note and mark its end
-            if event['note'] in note_timeline and note_timeline[event['note']]:
-                # Find the most recent unended note
-                for note_event in reversed(note_timeline[event['note']]):
-                    if note_event['end'] is None:
-                        note_event['end'] = current_time
-                        break
-    
-    # Detect measure length (assuming 4/4 time signature)
-    measure_length = 4 * ppqn  # 4 quarter notes per measure
-    
-    # Create a rhythm grid
-    max_time = max(absolute_times) if absolute_times else 0
-    measures = (max_time // measure_length) + 1
-    
-    # -- RHYTHMIC ANALYSIS --
-    
-    # Collect all onset positions for each measure
-    measure_onset_patterns = []
-    for measure in range(int(measures)):
-        measure_start = measure * measure_length
-        measure_end = (measure + 1) * measure_length
-        
-        # Get all onset times in this measure, normalized to 16th notes (0-15)
-        onsets = []
-        for time in sorted(notes_by_time.keys()):
-            if measure_start <= time < measure_end:
-                # Convert to 16th-note position (0-15) within the measure
-                pos_in_measure = (time - measure_start) // (ppqn // 4)
-                onsets.append(int(pos_in_measure))
-        
-        measure_onset_patterns.append(sorted(onsets))
-    
-    # Identify identical measures rhythmically
-    identical_rhythm_measures = defaultdict(list)
-    for i, pattern1 in enumerate(measure_onset_patterns):
-        for j, pattern2 in enumerate(measure_onset_patterns):
-            if i != j and pattern1 == pattern2:
-                identical_rhythm_measures[i].append(j)
-    
-    # Find rhythm measure groups
-    rhythm_measure_groups = []
-    processed = set()
-    
-    for i in range(len(measure_onset_patterns)):
-        if i in processed:
-            continue
-            
-        group = [i]
-        processed.add(i)
-        
-        for j in identical_rhythm_measures.get(i, []):
-            if j not in processed:
-                group.append(j)
-                processed.add(j)
-        
-        if group:
-            rhythm_measure_groups.append(sorted(group))
-    
-    # Analyze rhythmic pattern sequence
+    # Bucket every onset into its measure in a single pass, unless the
+    # caller already did so for the full analysis
+    if measure_patterns is None:
+        measure_patterns = extract_measure_patterns(event_types, notes, deltas, ppqn)
+    measure_masks, measure_note_sequences, _ = measure_patterns
+    
+    # Label each measure with a letter per distinct rhythm and per distinct
+    # melody in the same sweep. Rhythms compare the 16th-note slots each
+    # measure occupies, melodies hash the full note sequence (both timing and
+    # pitch). Letters are handed out in order of first occurrence: A, B, C, etc.
+    rhythm_ids = {}
+    melodic_ids = {}
     rhythm_pattern_sequence = []
-    rhythm_pattern_map = {}
-    
-    for i in range(len(rhythm_measure_groups)):
-        rhythm_pattern_map[i] = chr(65 + i)  # A, B, C, etc.
-    
-    for i in range(len(measure_onset_patterns)):
-        for group_idx, group in enumerate(rhythm_measure_groups):
-            if i in group:
-                rhythm_pattern_sequence.append(rhythm_pattern_map[group_idx])
-                break
-    
-    # -- MELODIC ANALYSIS --
-    
-    # Create a list of note sequences by measure, preserving onset order and notes
-    measure_note_sequences = []
-    
-    for measure in range(int(measures)):
-        measure_start = measure * measure_length
-        measure_end = (measure + 1) * measure_length
-        
-        # Get all notes with their onset times in this measure
-        measure_notes = []
-        for time in sorted(notes_by_time.keys()):
-            if measure_start <= time < measure_end:
-                # Convert to relative position in the measure (16th notes)
-                pos_in_measure = (time - measure_start) // (ppqn // 4)
-                # Include both position and notes
-                for note in sorted(notes_by_time[time]):
-                    measure_notes.append((int(pos_in_measure), note))
-        
-        # Sort by onset time within measure
-        measure_note_sequences.append(sorted(measure_notes))
-    
-    # Compare melodic sequences between measures
-    identical_melodic_measures = defaultdict(list)
-    for i, seq1 in enumerate(measure_note_sequences):
-        for j, seq2 in enumerate(measure_note_sequences):
-            if i != j:
-                # Compare full note sequences including both timing and pitch
-                if seq1 == seq2:
-                    identical_melodic_measures[i].append(j)
-    
-    # Find melodic measure groups
-    melodic_measure_groups = []
-    processed = set()
-    
-    for i in range(len(measure_note_sequences)):
-        if i in processed:
-            continue
-            
-        group = [i]
-        processed.add(i)
-        
-        for j in identical_melodic_measures.get(i, []):
-            if j not in processed:
-                group.append(j)
-                processed.add(j)
-        
-        if group:
-            melodic_measure_groups.append(sorted(group))
-    
-    # Analyze melodic pattern sequence
     melodic_pattern_sequence = []
-    melodic_pattern_map = {}
-    
-    for i in range(len(melodic_measure_groups)):
-        melodic_pattern_map[i] = chr(65 + i)  # A, B, C, etc.
-    
-    for i in range(len(measure_note_sequences)):
-        for group_idx, group in enumerate(melodic_measure_groups):
-            if i in group:
-                melodic_pattern_sequence.append(melodic_pattern_map[group_idx])
-                break
+    for mask, sequence in zip(measure_masks, measure_note_sequences):
+        rhythm_id = rhythm_ids.setdefault(mask, len(rhythm_ids))
+        rhythm_pattern_sequence.append(chr(65 + rhythm_id))
+        
+        melodic_id = melodic_ids.setdefault(tuple(sequence), len(melodic_ids))
+        melodic_pattern_sequence.append(chr(65 + melodic_id))
     
-    return ''.join(rhythm_pattern_sequence), ''.join(melodic_pattern_sequence), measure_onset_patterns
+    return ''.join(rhythm_pattern_sequence), ''.join(melodic_pattern_sequence), measure_masks
 
-def extract_unique_rhythm_patterns(measure_onset_patterns):
+def process_midi_file(midi_file, cache_dir=None):
     """
-    Extract unique 1-bar rhythm patterns from all measures
+    Process a single MIDI file and run the analysis
+    
+    This runs in a worker process, so everything the analysis prints is
+    captured and handed back with the results instead of going to stdout.
     
     Args:
-        measure_onset_patterns (list): List of onset patterns for each measure
+        midi_file (str): Path to MIDI file
+        cache_dir (str): Directory for cached note events, or None to disable
         
     Returns:
-        set: Set of unique rhythm patterns (as frozen sets for hashability)
+        tuple: (report, patterns), where report is the printed analysis text
+            and patterns is (rhythm_pattern, melodic_pattern,
+            measure_masks), or None if the file could not be analyzed
     """
-    # Convert each pattern to a frozenset for hashability
-    unique_patterns = set()
-    
-    for pattern in measure_onset_patterns:
-        # Convert to frozenset for hashability
-        unique_patterns.add(frozenset(pattern))
+    report = io.StringIO()
+    patterns = None
+    
+    with redirect_stdout(report):
+        print(f"\n\n{'=' * 80}")
+        print(f"Processing: {midi_file}")
+        print(f"{'=' * 80}")
+        
+        event_types, notes, deltas, ppqn = load_note_events(midi_file, cache_dir)
+        
+        if deltas and ppqn:
+            # Bucket the onsets into measures once, for both the full
+            # analysis and the pattern sequences. Without any onsets both
+            # return early, so there is nothing to bucket.
+            measure_patterns = None
+            if NOTE_ON in event_types:
+                measure_patterns = extract_measure_patterns(event_types, notes, deltas, ppqn)
+            
+            # Run the full analysis with output
+            analyze_rhythm_pattern(event_types, notes, deltas, ppqn, measure_patterns)
+            
+            # Extract just the patterns for our visualization
+            patterns = extract_pattern_sequences(event_types, notes, deltas, ppqn, measure_patterns)
+            rhythm_pattern, melodic_pattern, _ = patterns
+            
+            # Create and save JSON metadata file for this MIDI file
+            create_metadata_file(midi_file, rhythm_pattern, melodic_pattern)
+        else:
+            print(f"Could not analyze {midi_file}")
     
-    return unique_patterns
+    return report.getvalue(), patterns
 
-def process_midi_file(midi_file, rhythm_counter, melodic_counter, unique_rhythms, rhythm_pattern_counter, files_with_pattern):
+def collect_patterns(patterns, rhythm_counter, melodic_counter, unique_rhythms, rhythm_pattern_counter, files_with_pattern):
     """
-    Process a single MIDI file and run the analysis
+    Merge the patterns found in one MIDI file into the collection totals
     
     Args:
-        midi_file (str): Path to MIDI file
+        patterns (tuple): (rhythm_pattern, melodic_pattern, measure_masks)
+            as returned by process_midi_file
         rhythm_counter (Counter): Counter to collect rhythmic pattern data
         melodic_counter (Counter): Counter to collect melodic pattern data
-        unique_rhythms (set): Set to collect unique rhythm patterns
+        unique_rhythms (set): Set to collect unique rhythm patterns (as onset bitmasks)
         rhythm_pattern_counter (Counter): Counter to track frequency of each rhythm pattern
-        files_with_pattern (dict): Dictionary tracking which files contain each pattern
+        files_with_pattern (Counter): Counter with the number of files containing each pattern
     """
-    print(f"\n\n{'=' * 80}")
-    print(f"Processing: {midi_file}")
-    print(f"{'=' * 80}")
+    rhythm_pattern, melodic_pattern, measure_masks = patterns
     
-    note_events, ppqn = extract_note_events(midi_file)
+    # Store unique rhythm patterns
+    unique_rhythms.update(measure_masks)
     
-    if note_events and ppqn:
-        # Run the full analysis with output
-        analyze_rhythm_pattern(note_events, ppqn)
-        
-        # Extract just the patterns for our visualization
-        rhythm_pattern, melodic_pattern, measure_onset_patterns = extract_pattern_sequences(note_events, ppqn)
-        
-        # Extract and store unique rhythm patterns
-        file_unique_rhythms = extract_unique_rhythm_patterns(measure_onset_patterns)
-        unique_rhythms.update(file_unique_rhythms)
-        
-        # Count the frequency of each rhythm pattern
-        for pattern in measure_onset_patterns:
-            rhythm_pattern_counter[frozenset(pattern)] += 1
-        
-        # Track which patterns appear in this file (only count each pattern once per file)
-        file_patterns = set()
-        for pattern in measure_onset_patterns:
-            pattern_key = frozenset(pattern)
-            file_patterns.add(pattern_key)
-        
-        # Update the files_with_pattern dictionary for each unique pattern in this file
-        for pattern_key in file_patterns:
-            if pattern_key not in files_with_pattern:
-                files_with_pattern[pattern_key] = set()
-            files_with_pattern[pattern_key].add(midi_file)
-        
-        if rhythm_pattern:
-            rhythm_counter[rhythm_pattern] += 1
+    # Count the frequency of each rhythm pattern
+    rhythm_pattern_counter.update(measure_masks)
+    
+    # Count each pattern once per file
+    files_with_pattern.update(set(measure_masks))
+    
+    if rhythm_pattern:
+        rhythm_counter[rhythm_pattern] += 1
+    
+    if melodic_pattern:
+        melodic_counter[melodic_pattern] += 1
+
+def rank_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern, limit=None):
+    """
+    Rank rhythm patterns by number of files containing them, then by total
+    occurrences, then by number of onsets and bitmask value
+    
+    Args:
+        unique_rhythms (set): Set of unique rhythm patterns (as onset bitmasks)
+        rhythm_pattern_counter (Counter): Counter with frequency of each pattern
+        files_with_pattern (Counter): Counter with the number of files containing each pattern
+        limit (int, optional): Only rank this many of the most common patterns
         
-        if melodic_pattern:
-            melodic_counter[melodic_pattern] += 1
-            
-        # Create and save JSON metadata file for this MIDI file
-        create_metadata_file(midi_file, rhythm_pattern, melodic_pattern)
+    Returns:
+        list: (mask, num_files, total_occurrences) tuples, most common first
+    """
+    # Order plain key tuples so the comparisons stay in C; the masks are
+    # unique, so the last key field never ties
+    keys = (
+        (-files_with_pattern[mask], -rhythm_pattern_counter[mask], bin(mask).count('1'), mask)
+        for mask in unique_rhythms
+    )
+    
+    # When only the top few are wanted, select them with a bounded heap
+    # instead of sorting every pattern
+    if limit is None:
+        ranking = sorted(keys)
     else:
-        print(f"Could not analyze {midi_file}")
+        ranking = heapq.nsmallest(limit, keys)
+    return [(mask, -neg_files, -neg_occurrences) for neg_files, neg_occurrences, _, mask in ranking]
 
 def create_metadata_file(midi_file, rhythm_pattern, melodic_pattern):
     """
@@ -284,34 +217,39 @@ def create_metadata_file(midi_file, rhythm_pattern, melodic_pattern):
         rhythm_pattern (str): Rhythmic pattern (e.g. 'AABA')
         melodic_pattern (str): Melodic pattern (e.g. 'ABAB')
     """
-    # Create metadata structure
-    metadata = {
-        "phrasal": {
-            "rhythmic": {
-                "pattern": rhythm_pattern
-            },
-            "melodic": {
-                "pattern": melodic_pattern
-            }
-        }
-    }
+    # The metadata has a fixed shape, so fill in a template laid out exactly
+    # as json.dump(metadata, f, indent=4) would write it instead of running
+    # the general-purpose encoder. json.dumps still escapes the patterns.
+    metadata = (
+        '{\n'
+        '    "phrasal": {\n'
+        '        "rhythmic": {\n'
+        f'            "pattern": {json.dumps(rhythm_pattern)}\n'
+        '        },\n'
+        '        "melodic": {\n'
+        f'            "pattern": {json.dumps(melodic_pattern)}\n'
+        '        }\n'
+        '    }\n'
+        '}'
+    )
     
     # Generate metadata filename by replacing the MIDI extension with .json
     metadata_file = os.path.splitext(midi_file)[0] + ".json"
     
     # Save the metadata as JSON
     with open(metadata_file, 'w') as f:
-        json.dump(metadata, f, indent=4)
+        f.write(metadata)
     
     print(f"Created metadata file: {metadata_file}")
 
-def create_pattern_chart(rhythm_counter, melodic_counter):
+def create_pattern_chart(rhythm_counter, melodic_counter, show=False):
     """
     Create a bar chart showing the distribution of both rhythmic and melodic phrase patterns
     
     Args:
         rhythm_counter (Counter): Counter object with rhythmic pattern sequences and counts
         melodic_counter (Counter): Counter object with melodic pattern sequences and counts
+        show (bool): Whether to also display the chart in a window
     """
     if not rhythm_counter and not melodic_counter:
         print("No pattern data to visualize")
@@ -347,7 +285,7 @@ def create_pattern_chart(rhythm_counter, melodic_counter):
         
         # Adjust figure size based on number of patterns
         fig_width = max(12, len(sorted_patterns) * 0.8)
-        plt.figure(figsize=(fig_width, 8))
+        fig = plt.figure(figsize=(fig_width, 8))
         
         # Set up bar positions
         x = np.arange(len(sorted_patterns))
@@ -392,11 +330,13 @@ def create_pattern_chart(rhythm_counter, melodic_counter):
         plt.tight_layout()
         plt.subplots_adjust(bottom=0.15)  # Add space at bottom for rotated labels
         output_path = os.path.join(stats_dir, 'pattern_distribution.png')
-        plt.savefig(output_path)
+        fig.savefig(output_path)
         print(f"\nChart saved as: {output_path}")
         
-        # Show the chart
-        plt.show()
+        # Show the chart if requested, then release the figure
+        if show:
+            plt.show()
+        plt.close(fig)
         
         # Print full stats for all patterns if limited
         if len(combined_counter) > MAX_PATTERNS:
@@ -412,17 +352,19 @@ def create_pattern_chart(rhythm_counter, melodic_counter):
         print("\nWarning: matplotlib is not installed. Cannot create visualization.")
         print("To install, run: pip install matplotlib")
 
-def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files_with_pattern=None):
+def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files_with_pattern=None, show=False):
     """
     Create a visualization of the unique rhythm patterns
     
     Args:
-        unique_rhythms (set): Set of unique rhythm patterns
+        unique_rhythms (set): Set of unique rhythm patterns (as onset bitmasks)
         rhythm_pattern_counter (Counter, optional): Counter with frequency of each pattern
-        files_with_pattern (dict, optional): Dictionary tracking which files contain each pattern
+        files_with_pattern (Counter, optional): Counter with the number of files containing each pattern
+        show (bool): Whether to also display the chart in a window
     """
     try:
         import matplotlib.pyplot as plt
+        from matplotlib.collections import PatchCollection
         from matplotlib.patches import Rectangle
         import numpy as np
         
@@ -430,41 +372,31 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
         stats_dir = "stats"
         os.makedirs(stats_dir, exist_ok=True)
         
-        # Convert frozensets to sorted lists for better display
-        sorted_patterns = [sorted(list(pattern)) for pattern in unique_rhythms]
+        # Limit to top 30 patterns if there are many
+        MAX_PATTERNS = 30
         
         # If we have frequency data, sort by file frequency first, then by occurrence count
         if files_with_pattern and rhythm_pattern_counter:
-            # Create a list of (pattern, num_files, total_occurrences)
-            pattern_data = []
-            for pattern in sorted_patterns:
-                pattern_key = frozenset(pattern)
-                num_files = len(files_with_pattern.get(pattern_key, set()))
-                total_occurrences = rhythm_pattern_counter[pattern_key]
-                pattern_data.append((pattern, num_files, total_occurrences))
-            
-            # Sort by number of files first, then by total occurrences
-            pattern_data.sort(key=lambda x: (-x[1], -x[2], len(x[0]), x[0]))
+            # Only the patterns that will be drawn need ranking
+            pattern_data = rank_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern, MAX_PATTERNS)
             
             sorted_patterns = [p[0] for p in pattern_data]
             file_counts = [p[1] for p in pattern_data]
             occurrences = [p[2] for p in pattern_data]
         elif rhythm_pattern_counter:
             # Fall back to sorting by occurrence count if file data not available
-            pattern_freq = [(pattern, rhythm_pattern_counter[frozenset(pattern)]) for pattern in sorted_patterns]
-            pattern_freq.sort(key=lambda x: (-x[1], len(x[0]), x[0]))
+            pattern_freq = [(mask, rhythm_pattern_counter[mask]) for mask in unique_rhythms]
+            pattern_freq.sort(key=lambda x: (-x[1], bin(x[0]).count('1'), x[0]))
             sorted_patterns = [p[0] for p in pattern_freq]
             occurrences = [p[1] for p in pattern_freq]
             file_counts = None
         else:
-            # Default sort by length and content
-            sorted_patterns.sort(key=lambda x: (len(x), x if x else [-1]))
+            # Default sort by number of onsets and bitmask value
+            sorted_patterns = sorted(unique_rhythms, key=lambda mask: (bin(mask).count('1'), mask))
             occurrences = None
             file_counts = None
         
-        # Limit to top 30 patterns if there are many
-        MAX_PATTERNS = 30
-        if len(sorted_patterns) > MAX_PATTERNS:
+        if len(unique_rhythms) > MAX_PATTERNS:
             print(f"\nNote: Limiting visualization to {MAX_PATTERNS} patterns")
             sorted_patterns = sorted_patterns[:MAX_PATTERNS]
             if occurrences:
@@ -482,34 +414,36 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
         # Set background color for better contrast
         ax.set_facecolor('#f8f8f8')
         
-        # Draw the measures grid
-        for i in range(num_patterns):
-            y_pos = num_patterns - i - 1  # Reverse order for better visualization
-            
-            # Draw horizontal separator line
-            ax.axhline(y=y_pos-0.5, color='gray', linestyle='-', alpha=0.3, linewidth=1)
+        # Draw the measures grid: a horizontal separator line under each
+        # pattern (in reverse order for better visualization), plus a final
+        # line at the bottom. Each set of grid lines is a single collection
+        # spanning the full axes, like axhline/axvline.
+        separators = [num_patterns - i - 1 - 0.5 for i in range(num_patterns)] + [-0.5]
+        ax.hlines(separators, 0, 1, transform=ax.get_yaxis_transform(), color='gray', linestyle='-', alpha=0.3, linewidth=1)
         
-        # Add a final horizontal line at the bottom
-        ax.axhline(y=-0.5, color='gray', linestyle='-', alpha=0.3, linewidth=1)
+        # Draw vertical lines for beats, 0 to 4 (inclusive) to show measure boundaries
+        ax.vlines([beat * 4 for beat in range(5)], 0, 1, transform=ax.get_xaxis_transform(), color='gray', linestyle='-', alpha=0.5, linewidth=1)
+        
+        # Collect the beat shading and note markers of every pattern and add
+        # them as one collection each instead of one patch at a time
+        beat_shading = []
+        note_markers = []
         
-        # Draw vertical lines for beats
-        for beat in range(5):  # 0 to 4 (inclusive) to show measure boundaries
-            x_pos = beat * 4
-            ax.axvline(x=x_pos, color='gray', linestyle='-', alpha=0.5, linewidth=1)
-            
         # For each pattern, draw the rhythm
-        for i, pattern in enumerate(sorted_patterns):
+        for i, mask in enumerate(sorted_patterns):
             y_pos = num_patterns - i - 1  # Reverse order for better visualization
             
-            # Draw note markers
-            for pos in range(16):
-                # Background shading for beats
-                if pos % 4 == 0:
-                    ax.add_patch(Rectangle((pos, y_pos-0.4), 1, 0.8, facecolor='#e8e8e8', alpha=0.5, edgecolor=None))
-                    
-                # Draw notes
-                if pos in pattern:
-                    ax.add_patch(Rectangle((pos-0.35, y_pos-0.35), 0.7, 0.7, facecolor='royalblue', edgecolor='black', linewidth=0.5))
+            # Decode the pattern once for both the note markers and the text
+            onsets = mask_to_onsets(mask)
+            
+            # Background shading for beats
+            for pos in range(0, 16, 4):
+                beat_shading.append(Rectangle((pos, y_pos-0.4), 1, 0.8, facecolor='#e8e8e8', alpha=0.5, edgecolor=None))
+            
+            # Draw notes (the grid covers the 16 sixteenths of the measure)
+            for pos in onsets:
+                if pos < 16:
+                    note_markers.append(Rectangle((pos-0.35, y_pos-0.35), 0.7, 0.7, facecolor='royalblue', edgecolor='black', linewidth=0.5))
             
             # Add pattern label with frequency if available
             if file_counts and occurrences:
@@ -522,21 +456,7 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
             ax.text(-1, y_pos, label, va='center', ha='right', fontsize=10)
             
             # Add a small descriptive text of the pattern
-            readable_positions = []
-            for pos in pattern:
-                beat = (pos // 4) + 1
-                subdivision = pos % 4
-                
-                if subdivision == 0:
-                    beat_pos = f"{beat}"
-                elif subdivision == 1:
-                    beat_pos = f"{beat}.1"
-                elif subdivision == 2:
-                    beat_pos = f"{beat}.2"
-                else:
-                    beat_pos = f"{beat}.3"
-                    
-                readable_positions.append(beat_pos)
+            readable_positions = [READABLE_POS[pos] for pos in onsets]
             
             pattern_text = ' '.join(readable_positions)
             if len(pattern_text) > 25:  # Truncate if too long
@@ -544,6 +464,9 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
                 
             ax.text(17, y_pos, pattern_text, va='center', ha='left', fontsize=9, color='#444444')
         
+        ax.add_collection(PatchCollection(beat_shading, match_original=True))
+        ax.add_collection(PatchCollection(note_markers, match_original=True))
+        
         # Set the axis limits
         ax.set_xlim(-2, 20)  # Expanded to show pattern text
         ax.set_ylim(-0.5, num_patterns - 0.5)
@@ -555,15 +478,15 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
         # Remove y-axis ticks
         ax.set_yticks([])
         
-        # Add beat numbers
-        for beat in range(4):
-            ax.text(beat*4 + 2, -0.2, f'Beat {beat+1}', ha='center', va='top', fontsize=10, 
-                   bbox=dict(facecolor='white', alpha=0.7, edgecolor='none', pad=1))
+        # Label the beats on the x-axis, centred under each beat
+        ax.set_xticks([beat * 4 + 2 for beat in range(4)])
+        ax.set_xticklabels([f'Beat {beat+1}' for beat in range(4)], fontsize=10)
+        ax.tick_params(axis='x', length=0)
         
-        # Add a grid for sixteenth notes (faint vertical lines)
-        for pos in range(16):
-            if pos % 4 != 0:  # Only add lines that aren't on the beat
-                ax.axvline(x=pos, color='gray', linestyle='-', alpha=0.15, linewidth=0.5)
+        # Add a grid for sixteenth notes (faint vertical lines), only for the
+        # positions that aren't on the beat
+        off_beats = [pos for pos in range(16) if pos % 4 != 0]
+        ax.vlines(off_beats, 0, 1, transform=ax.get_xaxis_transform(), color='gray', linestyle='-', alpha=0.15, linewidth=0.5)
         
         # Draw x-axis to indicate the measure boundary
         ax.axhline(y=-0.5, color='black', linestyle='-', alpha=0.5, linewidth=1.5)
@@ -580,28 +503,32 @@ def visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter=None, files
         plt.tight_layout()
         plt.subplots_adjust(bottom=0.06)  # Add space for note at bottom
         output_path = os.path.join(stats_dir, 'rhythm_patterns.png')
-        plt.savefig(output_path, dpi=120)
+        fig.savefig(output_path, dpi=120)
         print(f"\nRhythm patterns visualization saved as: {output_path}")
         
-        # Show the chart
-        plt.show()
+        # Show the chart if requested, then release the figure
+        if show:
+            plt.show()
+        plt.close(fig)
         
     except ImportError:
         print("\nWarning: matplotlib is not installed. Cannot create visualization.")
         print("To install, run: pip install matplotlib")
 
-def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pattern=None):
+def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pattern=None, show=False):
     """
     Create a summary visualization of the most common rhythm patterns
     
     Args:
-        unique_rhythms (set): Set of unique rhythm patterns
+        unique_rhythms (set): Set of unique rhythm patterns (as onset bitmasks)
         rhythm_pattern_counter (Counter): Counter with frequency of each pattern
-        files_with_pattern (dict, optional): Dictionary tracking which files contain each pattern
+        files_with_pattern (Counter, optional): Counter with the number of files containing each pattern
+        show (bool): Whether to also display the chart in a window
     """
     try:
         import matplotlib.pyplot as plt
         import numpy as np
+        from matplotlib.collections import PatchCollection
         from matplotlib.patches import Rectangle
         
         # Create stats directory if it doesn't exist
@@ -611,24 +538,10 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
         # Only show the top patterns
         TOP_PATTERNS = 10
         
-        # Convert frozensets to sorted lists for better display
-        sorted_patterns = [sorted(list(pattern)) for pattern in unique_rhythms]
-        
         # If we have file frequency data, sort by that first
         if files_with_pattern:
-            # Create a list of (pattern, num_files, total_occurrences)
-            pattern_data = []
-            for pattern in sorted_patterns:
-                pattern_key = frozenset(pattern)
-                num_files = len(files_with_pattern.get(pattern_key, set()))
-                total_occurrences = rhythm_pattern_counter[pattern_key]
-                pattern_data.append((pattern, num_files, total_occurrences))
-            
-            # Sort by number of files first, then by total occurrences
-            pattern_data.sort(key=lambda x: (-x[1], -x[2], len(x[0]), x[0]))
-            
-            # Take only the top patterns
-            top_patterns_data = pattern_data[:TOP_PATTERNS]
+            # Rank only the top patterns
+            top_patterns_data = rank_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern, TOP_PATTERNS)
             
             # Extract data for plotting
             patterns = [p[0] for p in top_patterns_data]
@@ -641,11 +554,10 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
             bar_xlabel = 'Files Containing Pattern'
         else:
             # Fall back to sorting by occurrence count if file data not available
-            pattern_freq = [(pattern, rhythm_pattern_counter[frozenset(pattern)]) for pattern in sorted_patterns]
-            pattern_freq.sort(key=lambda x: (-x[1], len(x[0]), x[0]))
+            pattern_freq = [(mask, rhythm_pattern_counter[mask]) for mask in unique_rhythms]
             
             # Take only the top patterns
-            top_patterns = pattern_freq[:TOP_PATTERNS]
+            top_patterns = heapq.nsmallest(TOP_PATTERNS, pattern_freq, key=lambda x: (-x[1], bin(x[0]).count('1'), x[0]))
             
             # Extract data for plotting
             patterns = [p[0] for p in top_patterns]
@@ -658,7 +570,9 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
             bar_xlabel = 'Number of Occurrences'
         
         # Create a figure with two subplots - rhythm grid and frequency bar chart
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 8), gridspec_kw={'width_ratios': [3, 1]})
+        # constrained_layout fits the subplots and suptitle while drawing,
+        # without the extra render pass tight_layout needs
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 8), gridspec_kw={'width_ratios': [3, 1]}, constrained_layout=True)
         
         # Set background color
         ax1.set_facecolor('#f8f8f8')
@@ -667,27 +581,32 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
         # Create grid in first subplot
         num_patterns = len(patterns)
         
-        # Draw horizontal separator lines
-        for i in range(num_patterns + 1):
-            y_pos = i - 0.5
-            ax1.axhline(y=y_pos, color='gray', linestyle='-', alpha=0.3, linewidth=1)
+        # Draw horizontal separator lines, each set of grid lines as a single
+        # collection spanning the full axes, like axhline/axvline
+        separators = [i - 0.5 for i in range(num_patterns + 1)]
+        ax1.hlines(separators, 0, 1, transform=ax1.get_yaxis_transform(), color='gray', linestyle='-', alpha=0.3, linewidth=1)
+        
+        # Draw vertical lines for beats, 0 to 4 (inclusive) to show measure boundaries
+        ax1.vlines([beat * 4 for beat in range(5)], 0, 1, transform=ax1.get_xaxis_transform(), color='gray', linestyle='-', alpha=0.5, linewidth=1)
+        
+        # Collect the beat shading and note markers of every pattern and add
+        # them as one collection each instead of one patch at a time
+        beat_shading = []
+        note_markers = []
         
-        # Draw vertical lines for beats
-        for beat in range(5):  # 0 to 4 (inclusive) to show measure boundaries
-            x_pos = beat * 4
-            ax1.axvline(x=x_pos, color='gray', linestyle='-', alpha=0.5, linewidth=1)
-            
         # For each pattern, draw the rhythm
-        for i, pattern in enumerate(patterns):
-            # Draw note markers
-            for pos in range(16):
-                # Background shading for beats
-                if pos % 4 == 0:
-                    ax1.add_patch(Rectangle((pos, i-0.4), 1, 0.8, facecolor='#e8e8e8', alpha=0.5, edgecolor=None))
-                    
-                # Draw notes
-                if pos in pattern:
-                    ax1.add_patch(Rectangle((pos-0.35, i-0.35), 0.7, 0.7, facecolor='royalblue', edgecolor='black', linewidth=0.5))
+        for i, mask in enumerate(patterns):
+            # Decode the pattern once for both the note markers and the text
+            onsets = mask_to_onsets(mask)
+            
+            # Background shading for beats
+            for pos in range(0, 16, 4):
+                beat_shading.append(Rectangle((pos, i-0.4), 1, 0.8, facecolor='#e8e8e8', alpha=0.5, edgecolor=None))
+            
+            # Draw notes (the grid covers the 16 sixteenths of the measure)
+            for pos in onsets:
+                if pos < 16:
+                    note_markers.append(Rectangle((pos-0.35, i-0.35), 0.7, 0.7, facecolor='royalblue', edgecolor='black', linewidth=0.5))
             
             # Add pattern label with frequency
             if file_counts:
@@ -698,29 +617,18 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
             ax1.text(-1, i, label, va='center', ha='right', fontsize=10)
             
             # Add a small descriptive text of the pattern
-            readable_positions = []
-            for pos in pattern:
-                beat = (pos // 4) + 1
-                subdivision = pos % 4
-                
-                if subdivision == 0:
-                    beat_pos = f"{beat}"
-                elif subdivision == 1:
-                    beat_pos = f"{beat}.1"
-                elif subdivision == 2:
-                    beat_pos = f"{beat}.2"
-                else:
-                    beat_pos = f"{beat}.3"
-                    
-                readable_positions.append(beat_pos)
+            readable_positions = [READABLE_POS[pos] for pos in onsets]
             
             pattern_text = ' '.join(readable_positions)
             ax1.text(17, i, pattern_text, va='center', ha='left', fontsize=9, color='#444444')
         
-        # Add a grid for sixteenth notes (faint vertical lines)
-        for pos in range(16):
-            if pos % 4 != 0:  # Only add lines that aren't on the beat
-                ax1.axvline(x=pos, color='gray', linestyle='-', alpha=0.15, linewidth=0.5)
+        ax1.add_collection(PatchCollection(beat_shading, match_original=True))
+        ax1.add_collection(PatchCollection(note_markers, match_original=True))
+        
+        # Add a grid for sixteenth notes (faint vertical lines), only for the
+        # positions that aren't on the beat
+        off_beats = [pos for pos in range(16) if pos % 4 != 0]
+        ax1.vlines(off_beats, 0, 1, transform=ax1.get_xaxis_transform(), color='gray', linestyle='-', alpha=0.15, linewidth=0.5)
         
         # Set the axis limits for the grid
         ax1.set_xlim(-2, 20)
@@ -733,18 +641,17 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
         # Remove y-axis ticks
         ax1.set_yticks([])
         
-        # Add beat numbers
-        for beat in range(4):
-            ax1.text(beat*4 + 2, -0.2, f'Beat {beat+1}', ha='center', va='top', fontsize=10, 
-                    bbox=dict(facecolor='white', alpha=0.7, edgecolor='none', pad=1))
+        # Label the beats on the x-axis, centred under each beat
+        ax1.set_xticks([beat * 4 + 2 for beat in range(4)])
+        ax1.set_xticklabels([f'Beat {beat+1}' for beat in range(4)], fontsize=10)
+        ax1.tick_params(axis='x', length=0)
         
         # Create frequency bar chart in second subplot
         y_pos = np.arange(num_patterns)
-        ax2.barh(y_pos, bar_values, color='royalblue', edgecolor='black', alpha=0.7)
+        bars = ax2.barh(y_pos, bar_values, color='royalblue', edgecolor='black', alpha=0.7)
         
         # Add labels to bars
-        for i, val in enumerate(bar_values):
-            ax2.text(val + max(bar_values) * 0.02, i, str(val), va='center', fontsize=10)
+        ax2.bar_label(bars, padding=3, fontsize=10)
         
         # Set the axis limits for the bar chart
         ax2.set_xlim(0, max(bar_values) * 1.15)
@@ -762,21 +669,19 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
         
         # Overall title
         if file_counts:
-            plt.suptitle(f'Top {num_patterns} Rhythm Patterns by Number of Files (out of {len(unique_rhythms)} total patterns)', 
-                        fontsize=16, y=0.98)
+            plt.suptitle(f'Top {num_patterns} Rhythm Patterns by Number of Files (out of {len(unique_rhythms)} total patterns)', fontsize=16)
         else:
-            plt.suptitle(f'Top {num_patterns} Most Common 1-bar Rhythm Patterns (out of {len(unique_rhythms)} total)', 
-                        fontsize=16, y=0.98)
+            plt.suptitle(f'Top {num_patterns} Most Common 1-bar Rhythm Patterns (out of {len(unique_rhythms)} total)', fontsize=16)
         
-        # Adjust layout and save
-        plt.tight_layout()
-        plt.subplots_adjust(top=0.9)
+        # Save the chart
         output_path = os.path.join(stats_dir, 'rhythm_summary.png')
-        plt.savefig(output_path, dpi=120)
+        fig.savefig(output_path, dpi=120)
         print(f"\nSummary chart saved as: {output_path}")
         
-        # Show the chart
-        plt.show()
+        # Show the chart if requested, then release the figure
+        if show:
+            plt.show()
+        plt.close(fig)
         
     except ImportError:
         print("\nWarning: matplotlib is not installed. Cannot create visualization.")
@@ -785,14 +690,26 @@ def create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pat
 def main():
     parser = argparse.ArgumentParser(description='Analyze MIDI files for rhythm patterns')
     parser.add_argument('directory', help='Directory to search for MIDI files')
+    parser.add_argument('--cache-dir', help='Directory for caching parsed note events between runs')
+    parser.add_argument('--show', action='store_true', help='Display each chart in a window after saving it')
     
     args = parser.parse_args()
     
+    # Without --show the charts are only saved, so render them with the
+    # non-interactive Agg backend and skip GUI toolkit startup
+    if not args.show:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+        except ImportError:
+            pass
+    
     if not os.path.isdir(args.directory):
         print(f"Error: {args.directory} is not a valid directory")
         sys.exit(1)
     
-    midi_files = find_midi_files(args.directory)
+    # The file count is reported up front, so collect the paths first
+    midi_files = list(find_midi_files(args.directory))
     
     if not midi_files:
         print(f"No MIDI files found in {args.directory}")
@@ -810,12 +727,18 @@ def main():
     # Initialize counter for rhythm pattern frequency
     rhythm_pattern_counter = Counter()
     
-    # Initialize dictionary to track which files contain each pattern
-    files_with_pattern = {}
+    # Initialize counter for the number of files containing each pattern
+    files_with_pattern = Counter()
     
-    # Process all files and collect pattern data
-    for midi_file in midi_files:
-        process_midi_file(midi_file, rhythm_counter, melodic_counter, unique_rhythms, rhythm_pattern_counter, files_with_pattern)
+    # Analyze the files in parallel worker processes. imap hands the results
+    # back in file order, so the reports and totals don't depend on timing.
+    analyze_file = partial(process_midi_file, cache_dir=args.cache_dir)
+    with multiprocessing.Pool() as pool:
+        for report, patterns in pool.imap(analyze_file, midi_files, chunksize=8):
+            sys.stdout.write(report)
+            
+            if patterns is not None:
+                collect_patterns(patterns, rhythm_counter, melodic_counter, unique_rhythms, rhythm_pattern_counter, files_with_pattern)
     
     # Print the number of unique 1-bar rhythm patterns found
     print("\n\n" + "=" * 80)
@@ -824,7 +747,7 @@ def main():
     # After processing all files, create and display the chart
     print("\n\n" + "=" * 80)
     print("Generating pattern distribution visualization...")
-    create_pattern_chart(rhythm_counter, melodic_counter)
+    create_pattern_chart(rhythm_counter, melodic_counter, args.show)
 
     # Display detailed information about the unique rhythm patterns
     if unique_rhythms:
@@ -832,49 +755,26 @@ def main():
         print("Unique 1-bar rhythm patterns (sorted by number of files containing them, then total occurrences):")
         print("-" * 40)
         
-        # Convert frozensets to sorted lists for better display
-        sorted_patterns = [sorted(list(pattern)) for pattern in unique_rhythms]
-        
-        # Sort by number of files first, then by occurrence count
-        pattern_data = []
-        for pattern in sorted_patterns:
-            pattern_key = frozenset(pattern)
-            num_files = len(files_with_pattern.get(pattern_key, set()))
-            total_occurrences = rhythm_pattern_counter[pattern_key]
-            pattern_data.append((pattern, num_files, total_occurrences))
-        
-        pattern_data.sort(key=lambda x: (-x[1], -x[2], len(x[0]), x[0]))
+        # Sort by number of files first, then by occurrence count, then by
+        # number of onsets and bitmask value
+        pattern_data = rank_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern)
         
-        for i, (pattern, num_files, freq) in enumerate(pattern_data, 1):
+        for i, (mask, num_files, freq) in enumerate(pattern_data, 1):
             # Convert 16th note positions to more readable format (1.1, 1.2, etc.)
-            readable_positions = []
-            for pos in pattern:
-                beat = (pos // 4) + 1
-                subdivision = pos % 4
-                
-                if subdivision == 0:
-                    beat_pos = f"{beat}"
-                elif subdivision == 1:
-                    beat_pos = f"{beat}.1"
-                elif subdivision == 2:
-                    beat_pos = f"{beat}.2"
-                else:
-                    beat_pos = f"{beat}.3"
-                    
-                readable_positions.append(beat_pos)
+            readable_positions = [READABLE_POS[pos] for pos in mask_to_onsets(mask)]
             
             print(f"Pattern {i}: {' '.join(readable_positions)} (in {num_files} files, occurs {freq} times)")
         
         # Create visualization of the rhythm patterns with frequency information
         print("\n\n" + "=" * 80)
         print("Generating rhythm patterns visualization...")
-        visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern)
+        visualize_rhythm_patterns(unique_rhythms, rhythm_pattern_counter, files_with_pattern, args.show)
         
         # Create summary visualization of most common patterns if we have enough patterns
         if len(unique_rhythms) > 5:
             print("\n\n" + "=" * 80)
             print("Generating summary of most common rhythm patterns...")
-            create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pattern)
+            create_rhythm_summary(unique_rhythms, rhythm_pattern_counter, files_with_pattern, args.show)
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file